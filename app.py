@@ -14,9 +14,10 @@
 
 import vertexai
 import os
+import hashlib
 import logging
 import random
-import traceback
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 
 from google import genai
@@ -27,9 +28,9 @@ from google.api_core.client_options import ClientOptions
 import firebase_admin
 from firebase_admin import credentials, firestore
 
-from flask import Flask, request, jsonify #, render_template
+from flask import Flask, Response, request, jsonify, stream_with_context #, render_template
 
-from common import audiostream, config as configuration, function_calling
+from common import audiostream, cache, config as configuration, function_calling
 from services.user import User as UserService
 
 # Environment variables
@@ -38,7 +39,7 @@ PROJECT_ID = os.environ.get("PROJECT_ID", "dn-demos")
 REGION = os.environ.get("REGION", "us-central1")
 FAKE_USER_ID = "7608dc3f-d239-405c-a097-b152ab38a354"
 
-DEFAULT_SAFETY_SETTINGS = [
+DEFAULT_SAFETY_SETTINGS = (
                 types.SafetySetting(
                     category='HARM_CATEGORY_UNSPECIFIED',
                     threshold='BLOCK_ONLY_HIGH',
@@ -59,19 +60,26 @@ DEFAULT_SAFETY_SETTINGS = [
                     category='HARM_CATEGORY_HATE_SPEECH',
                     threshold='BLOCK_ONLY_HIGH',
                 )                
-            ]
+            )
 
 logging.basicConfig()
-logging.getLogger().setLevel(logging.DEBUG)
+logging.getLogger().setLevel(logging.DEBUG if os.environ.get("DEBUG") else logging.INFO)
 
 vertexai.init(project=PROJECT_ID, location=REGION)
 
 # Config file loader
 config = configuration.Config.get_instance()
 
-# Our main chat config with system instructions
+# Values read on the request path, resolved once at startup
+LLM_GEMINI_VERSION = config.get_property('general', 'llm_gemini_version')
+GENERIC_ERROR_MESSAGE = config.get_property('chatbot', 'generic_error_message')
+AUDIO_TRANSCRIPTION_INSTRUCTION = config.get_property('chatbot', 'audio_transcription_instruction')
+DEFAULT_AUDIO_RESPONSE = config.get_property('chatbot', 'default_audio_response')
+SYSTEM_INSTRUCTION = config.get_property('chatbot', 'llm_system_instruction') + config.get_property('chatbot', 'llm_response_type')
+
+# Our main chat config with system instructions, shared by every chat session
 chat_config = types.GenerateContentConfig(
-    system_instruction=config.get_property('chatbot', 'llm_system_instruction') + config.get_property('chatbot', 'llm_response_type'),
+    system_instruction=SYSTEM_INSTRUCTION,
     tools=[UserService.get_function_declarations()],
     safety_settings=DEFAULT_SAFETY_SETTINGS,        
     automatic_function_calling=types.AutomaticFunctionCallingConfig(
@@ -93,18 +101,25 @@ def init_client() -> genai.Client:
 
 # Chat initialization per tenant (cleanup needed after timeout/logout)
 def init_client_chat(client: genai.Client, user_id) -> chats.Chat:
-    if user_id in client_sessions and client_sessions[user_id] != None:
+    session = client_sessions.get(user_id)
+    if session is not None:
         logging.debug("Re-using existing session")
-        return client_sessions[user_id]
+        return session
 
-    logging.debug("Creating new chat session for user %s", user_id)
+    # Re-check under the lock so concurrent first requests share one session
+    with client_sessions.lock:
+        session = client_sessions.get(user_id)
+        if session is not None:
+            return session
 
-    gemini_client = client.chats.create(
-        model=config.get_property('general', 'llm_gemini_version'), config=chat_config, 
-    )
+        logging.debug("Creating new chat session for user %s", user_id)
 
-    client_sessions[user_id] = gemini_client
-    return client_sessions[user_id]
+        gemini_client = client.chats.create(
+            model=LLM_GEMINI_VERSION, config=chat_config, 
+        )
+
+        client_sessions.put(user_id, gemini_client)
+        return gemini_client
 
 app = Flask(
     __name__,
@@ -123,7 +138,94 @@ socketio = SocketIO(app, cors_allowed_origins="*")
 user_service = UserService(db_client, config, gemini_client, socketio)
 
 # Init our session handling variables
-client_sessions = {}
+client_sessions = cache.ChatSessionCache(
+    max_sessions=int(config.get_property('chatbot', 'max_sessions')),
+    ttl=int(config.get_property('chatbot', 'session_ttl')),
+)
+
+# Pays one-off startup costs while the container starts (and benefits from
+# startup CPU boost) instead of on the first request: the Firestore gRPC channel,
+# and loading credentials plus minting the OAuth token for Gemini. The genai SDK
+# opens a new session per call, so no Gemini connection is kept for reuse.
+# Best-effort: the Firestore probe is bounded and not retried so it can't stall startup.
+def warmup():
+    try:
+        db_client.collection("models").limit(1).get(timeout=5, retry=None)
+    except Exception as e:
+        logging.warning("Firestore warm-up failed: %s", e)
+
+    try:
+        gemini_client.models.get(model=LLM_GEMINI_VERSION)
+    except Exception as e:
+        logging.warning("Gemini warm-up failed: %s", e)
+
+warmup()
+
+# Runs function calls while the rest of the model's response is still streaming
+function_executor = ThreadPoolExecutor(max_workers=8)
+
+# Sends a message and yields the reply text as it streams in. A function call is
+# dispatched as soon as its chunk arrives; its result is streamed back to the model
+# and the final reply is yielded, followed by the function's HTML.
+def stream_chat_turn(chat: chats.Chat, message):
+    function_call_part = None
+    function_future = None
+
+    # Errors end the turn with the generic message, whatever was already sent
+    try:
+        # Drain the whole stream, the chat history is only recorded once it is consumed
+        for chunk in chat.send_message_stream(message):
+            if chunk.function_calls:
+                # Keep any text that came in the same chunk as the function call
+                yield "".join(part.text for part in chunk.candidates[0].content.parts if part.text)
+
+                if function_future is None:
+                    function_call_part = chunk.function_calls[0]
+
+                    logging.info("Calling %s", function_call_part.name)
+                    logging.debug("Function call args: %s", function_call_part.args)
+
+                    function_call_args = dict(function_call_part.args or {})
+                    function_call_args['user_id'] = FAKE_USER_ID
+                    function_future = function_executor.submit(function_calling.call_function, user_service, function_call_part.name, function_call_args)
+                continue
+
+            yield function_calling.extract_text(chunk) or ''
+
+        if function_future is None:
+            return
+
+        function_result, html_response = function_future.result()
+
+        function_response_part = types.Part.from_function_response(
+            name=function_call_part.name,
+            response={
+                'result': function_result
+            }
+        )
+
+        for chunk in chat.send_message_stream(function_response_part):
+            yield function_calling.extract_text(chunk) or ''
+
+    except Exception as e:
+        logging.exception("Chat turn failed: %s", e)
+        yield GENERIC_ERROR_MESSAGE
+        return
+
+    yield html_response
+
+def stream_chat_html(chat: chats.Chat, message):
+    yield '<div class="msg">'
+
+    empty = True
+    for fragment in function_calling.clean_gemini_stream(stream_chat_turn(chat, message)):
+        empty = empty and not fragment
+        yield fragment
+
+    if empty:
+        yield GENERIC_ERROR_MESSAGE
+
+    yield '</div>'
 
 # Our main chat handler
 @app.route("/chat", methods=["POST"])
@@ -132,129 +234,109 @@ def chat():
     chat = init_client_chat(gemini_client, FAKE_USER_ID)
     audio = audiostream.get_audio_stream(request)
 
+    # Text prompts are streamed back to the browser as they are generated
+    if audio == None:
+        prompt = types.Part.from_text(text=request.form.get("prompt"))
+        return Response(stream_with_context(stream_chat_html(chat, prompt)), mimetype="text/html")
+
     # If we got audio stream input, let's convert it first to text via gemini flash
-    if audio != None: 
-        transcribed_audio_response = gemini_client.models.generate_content(
-            model=config.get_property('general', 'llm_gemini_version'),
-            contents=[
-                config.get_property('chatbot', 'audio_transcription_instruction'),
-                types.Part.from_bytes(data=audio, mime_type='audio/mpeg')
-            ]
-        )
-        
-        prompt = transcribed_audio_response.text
-        logging.debug(f"Transcribed audio: %s", prompt)
+    transcribed_audio_response = gemini_client.models.generate_content(
+        model=LLM_GEMINI_VERSION,
+        contents=[
+            AUDIO_TRANSCRIPTION_INSTRUCTION,
+            types.Part.from_bytes(data=audio, mime_type='audio/mpeg')
+        ]
+    )
+    
+    prompt = transcribed_audio_response.text
+    logging.debug("Transcribed audio: %s", prompt)
+    
+    # Now that we have the audio in text for, so we can send it further to our pipeline.
+    # Speech synthesis needs the complete reply, so the stream is collected here.
+    text_response = "".join(stream_chat_turn(chat, prompt))
+
+    if len(text_response) == 0:
+        text_response = GENERIC_ERROR_MESSAGE
         
-        # Now that we have the audio in text for, so we can send it further to our pipeline
-        response = chat.send_message(message=prompt, config=chat_config)
-    else:        
-        prompt = types.Part.from_text(text=request.form.get("prompt"))
-        response = chat.send_message(message=prompt, config=chat_config)
-
-    if response.function_calls is not None:
-        try:
-            function_call_part = response.function_calls[0]
-            function_call_name = function_call_part.name
-            function_call_args = function_call_part.args
-            function_call_content = response.candidates[0].content
-
-            logging.info("Calling " + function_call_name)
-            logging.info(function_call_args)
-            logging.info(function_call_content)
-            
-            function_call_args['user_id'] = FAKE_USER_ID
-            function_result, html_response = function_calling.call_function(user_service, function_call_name, function_call_args)
-
-            function_response_part = types.Part.from_function_response(
-                name=function_call_part.name,
-                response={
-                    'result': function_result
-                }
-            )
 
-            response = chat.send_message(message=function_response_part, config=chat_config)
-            text_response = function_calling.extract_text(response) + html_response
+    # call google text to voice api and synthesize text_response in english
+    audio_file_path = os.path.join('static/audio_output', f'output_{FAKE_USER_ID}{str(random.randint(0, 10000)) }.wav')
 
-        except TypeError as e:
-            logging.error("%s, %s", traceback.format_exc(), e)
-            text_response = config.get_property('chatbot', 'generic_error_message')
+    TTS_LOCATION = "global"
 
-        except Exception as e:
-            logging.error("%s, %s", traceback.format_exc(), e)
-            text_response = config.get_property('chatbot', 'generic_error_message')
-    else:
-        text_response = function_calling.extract_text(response)
+    # Instantiates a client
+    API_ENDPOINT = (
+        f"{TTS_LOCATION}-texttospeech.googleapis.com"
+        if TTS_LOCATION != "global"
+        else "texttospeech.googleapis.com"
+    )
 
-    if len(text_response) == 0:
-        text_response = config.get_property('chatbot', 'generic_error_message')
+    client = texttospeech.TextToSpeechClient(
+        client_options=ClientOptions(api_endpoint=API_ENDPOINT)
+    )
         
+    soup = BeautifulSoup(text_response, 'html.parser')
+    text_response_without_html = soup.get_text()
 
-    if audio != None:
-        # call google text to voice api and synthesize text_response in english
-        audio_file_path = os.path.join('static/audio_output', f'output_{FAKE_USER_ID}{str(random.randint(0, 10000)) }.wav')
-
-        TTS_LOCATION = "global"
+    # Set the text input to be synthesized (if it doesn't contain html)
+    if "</table>" in text_response:
+        synthesis_input = texttospeech.SynthesisInput(text=DEFAULT_AUDIO_RESPONSE)
+    else:
+        synthesis_input = texttospeech.SynthesisInput(text=text_response_without_html)
 
-        # Instantiates a client
-        API_ENDPOINT = (
-            f"{TTS_LOCATION}-texttospeech.googleapis.com"
-            if TTS_LOCATION != "global"
-            else "texttospeech.googleapis.com"
-        )
+    # Build the voice request, select the language code ("en-US") and the SSML
+    # voice gender ("MALE")
+    voice = "Aoede"  # @param ["Aoede", "Puck", "Charon", "Kore", "Fenrir", "Leda", "Orus", "Zephyr"]
+    language_code = "en-US"  # @param [ "de-DE", "en-AU", "en-GB", "en-IN", "en-US", "fr-FR", "hi-IN", "pt-BR", "ar-XA", "es-ES", "fr-CA", "id-ID", "it-IT", "ja-JP", "tr-TR", "vi-VN", "bn-IN", "gu-IN", "kn-IN", "ml-IN", "mr-IN", "ta-IN", "te-IN", "nl-NL", "ko-KR", "cmn-CN", "pl-PL", "ru-RU", "th-TH"]
+    voice_name = f"{language_code}-Chirp3-HD-{voice}"
 
-        client = texttospeech.TextToSpeechClient(
-            client_options=ClientOptions(api_endpoint=API_ENDPOINT)
-        )
-            
-        soup = BeautifulSoup(text_response, 'html.parser')
-        text_response_without_html = soup.get_text()
-
-        # Set the text input to be synthesized (if it doesn't contain html)
-        if "</table>" in text_response:
-            synthesis_input = texttospeech.SynthesisInput(text=config.get_property('chatbot', 'default_audio_response'))
-        else:
-            synthesis_input = texttospeech.SynthesisInput(text=text_response_without_html)
-
-        # Build the voice request, select the language code ("en-US") and the SSML
-        # voice gender ("MALE")
-        voice = "Aoede"  # @param ["Aoede", "Puck", "Charon", "Kore", "Fenrir", "Leda", "Orus", "Zephyr"]
-        language_code = "en-US"  # @param [ "de-DE", "en-AU", "en-GB", "en-IN", "en-US", "fr-FR", "hi-IN", "pt-BR", "ar-XA", "es-ES", "fr-CA", "id-ID", "it-IT", "ja-JP", "tr-TR", "vi-VN", "bn-IN", "gu-IN", "kn-IN", "ml-IN", "mr-IN", "ta-IN", "te-IN", "nl-NL", "ko-KR", "cmn-CN", "pl-PL", "ru-RU", "th-TH"]
-        voice_name = f"{language_code}-Chirp3-HD-{voice}"
-
-        voice = texttospeech.VoiceSelectionParams(
-            name=voice_name, language_code=language_code, ssml_gender=texttospeech.SsmlVoiceGender.MALE
-        )
+    voice = texttospeech.VoiceSelectionParams(
+        name=voice_name, language_code=language_code, ssml_gender=texttospeech.SsmlVoiceGender.MALE
+    )
 
-        # Select the type of audio file you want returned
-        audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.LINEAR16)
+    # Select the type of audio file you want returned
+    audio_config = texttospeech.AudioConfig(audio_encoding=texttospeech.AudioEncoding.LINEAR16)
 
-        # Perform the text-to-speech request
-        response = client.synthesize_speech(
-            input=synthesis_input, voice=voice, audio_config=audio_config
-        )
+    # Perform the text-to-speech request
+    response = client.synthesize_speech(
+        input=synthesis_input, voice=voice, audio_config=audio_config
+    )
 
-        # The response's audio_content is binary.
-        with open(audio_file_path, "wb") as out:
-            out.write(response.audio_content)
+    # The response's audio_content is binary.
+    with open(audio_file_path, "wb") as out:
+        out.write(response.audio_content)
 
-        # Return the HTML audio element pointing to the synthesized audio file
-        text_response += f"""
-        <br><br>
-        <audio controls autoplay>
-            <source src="/{audio_file_path}" type="audio/wav">
-            Your browser does not support the audio element.
-        </audio>
-        """
+    # Return the HTML audio element pointing to the synthesized audio file
+    text_response += f"""
+    <br><br>
+    <audio controls autoplay>
+        <source src="/{audio_file_path}" type="audio/wav">
+        Your browser does not support the audio element.
+    </audio>
+    """
 
     return function_calling.gemini_response_to_template_html(text_response)
 
+def load_index_html():
+    with open("templates/index.html", mode='rb') as file:
+        data = file.read()
+
+    return data, hashlib.blake2b(data, digest_size=8).hexdigest()
+
+# Served from memory; DEV_MODE re-reads the template on every request
+INDEX_HTML, INDEX_ETAG = load_index_html()
+
 @app.route("/", methods=["GET"])
 def home():
-#    if os.environ.get("DEV_MODE") == "true":
-    with open("templates/index.html", mode='r') as file: #
-        data = file.read()
+    data, etag = load_index_html() if os.environ.get("DEV_MODE") == "true" else (INDEX_HTML, INDEX_ETAG)
+
+    response = Response(data, mimetype="text/html")
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
 
-    return data
+    # Answers If-None-Match with a 304
+    return response.make_conditional(request)
     
 #    return render_template("index.html")
 
@@ -278,8 +360,7 @@ def get_model():
 
 @app.route("/reset", methods=["GET"])
 def reset():
-    for uid in client_sessions:
-        client_sessions[uid] = None
+    client_sessions.clear()
 
     return jsonify({'status': 'ok'}), 200
 
@@ -0,0 +1,99 @@
+# Copyright 2024 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+import threading
+from collections import OrderedDict
+
+# Bounded cache with per-entry TTL. Entries are kept ordered by timestamp, so
+# expired ones always sit at the front and the sweep stops at the first live one.
+# Every operation (reads included) runs under the same lock; `lock` is exposed
+# for check-then-create callers.
+
+class TTLCache:
+    # Whether a hit restarts the entry's TTL and moves it to the back (idle
+    # expiry, LRU eviction) or leaves it in place (age expiry, oldest evicted first)
+    refresh_on_get = False
+
+    def __init__(self, max_size, ttl):
+        """
+        Initializes the cache.
+
+        Args:
+            max_size: Maximum number of entries kept in memory.
+            ttl: Seconds after which an entry expires.
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1, got %s" % max_size)
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            timestamp, value = entry
+            if time.monotonic() - timestamp > self.ttl:
+                del self._entries[key]
+                return None
+
+            # Reordering only together with a new timestamp keeps the dict sorted by age
+            if self.refresh_on_get:
+                self._entries[key] = (time.monotonic(), value)
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self._entries.pop(key, None)
+            self._evict_expired()
+
+            while len(self._entries) >= self.max_size:
+                self._entries.popitem(last=False)
+
+            self._entries[key] = (time.monotonic(), value)
+
+    def pop(self, key):
+        with self.lock:
+            entry = self._entries.pop(key, None)
+            return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evict_expired(self):
+        # Sweep from the oldest end until a live entry is found
+        now = time.monotonic()
+        while self._entries:
+            timestamp, _ = next(iter(self._entries.values()))
+            if now - timestamp <= self.ttl:
+                break
+            self._entries.popitem(last=False)
+
+# Chat sessions expire after being idle, so each hit restarts their TTL
+
+class ChatSessionCache(TTLCache):
+    refresh_on_get = True
+
+    def __init__(self, max_sessions, ttl):
+        super().__init__(max_size=max_sessions, ttl=ttl)
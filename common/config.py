@@ -13,6 +13,7 @@
 # limitations under the License.
 
 import configparser
+import functools
 
 # Singleton config class
 
@@ -39,6 +40,10 @@ class Config:
             config.read_file(file)
             self.config = config
 
+        # Values may have changed, drop anything memoized from a previous read
+        Config.get_property.cache_clear()
+
+    @functools.lru_cache(maxsize=128)
     def get_property(self, section, key):
         return self.config.get(section, key).strip('"')
 
@@ -18,7 +18,7 @@ def call_function(service, function_name, params):
     try:
         return getattr(service, function_name)(**params)
     except Exception as e:
-        logging.error("Cannot invoke the function dynamically. Exception: " + e)
+        logging.error("Cannot invoke the function dynamically. Exception: %s", e)
         return 'Unable to retrieve data from external source'
 
 def extract_function(response):
@@ -29,7 +29,7 @@ def extract_function(response):
     except AttributeError as e:
         return None
     except Exception as e:
-        logging.error("Cannot extract function name from gemini response. Exception: " + e)
+        logging.error("Cannot extract function name from gemini response. Exception: %s", e)
 
 def extract_params(response):
     params = {}
@@ -41,7 +41,7 @@ def extract_params(response):
     except AttributeError as e:
         return params
     except Exception as e:
-        logging.error("Cannot extract function parameters name from gemini response. Exception: %e" + e)
+        logging.error("Cannot extract function parameters name from gemini response. Exception: %s", e)
 
     return params
 
@@ -55,16 +55,45 @@ def extract_text(response):
     except AttributeError as e:
         return ""
     except Exception as e:
-        logging.error("Cannot extract text name from gemini response. Exception: " + e)
+        logging.error("Cannot extract text name from gemini response. Exception: %s", e)
     
     return ""
     
+# Sometimes gemini produces empty paragraphs as well as markdown in html outputs
+GEMINI_REPLACEMENTS = (
+    ('<p></p>', ''),
+    ('```html', ''),
+    ('```', ''),
+    ('\\"', '"'),
+)
+
+def clean_gemini_text(response):
+    for marker, replacement in GEMINI_REPLACEMENTS:
+        response = response.replace(marker, replacement)
+
+    return response
+
+def clean_gemini_stream(fragments):
+    # Text that could be the start of a marker is held back until the next fragment
+    pending = ''
+    for fragment in fragments:
+        pending += fragment
+        cut = len(pending) - partial_marker_length(pending)
+        if cut > 0:
+            yield clean_gemini_text(pending[:cut])
+            pending = pending[cut:]
+
+    yield clean_gemini_text(pending)
+
+def partial_marker_length(text):
+    for length in range(min(len(text), max(len(m) for m, _ in GEMINI_REPLACEMENTS)), 0, -1):
+        if any(marker.startswith(text[-length:]) for marker, _ in GEMINI_REPLACEMENTS):
+            return length
+
+    return 0
+
 def gemini_response_to_template_html(response):
-    # Sometimes gemini produces empty paragraphs as well as markdown in html outputs
-    response = response.replace('<p></p>', '') 
-    response = response.replace('```html', '')
-    response = response.replace('```', '')
-    response = response.replace('\\"', '"')
+    response = clean_gemini_text(response)
     
     return """
         <div class="msg">""" + response + """</div>
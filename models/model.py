@@ -15,6 +15,9 @@
 import json
 
 class Model:
+    # Document fields read by from_dict, used to project Firestore reads
+    FIELDS = ["user_id", "original_material", "model", "color"]
+
     def __init__(self, user_id, original_material, model, color):
         self.original_material = original_material
         self.model = model
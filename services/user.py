@@ -12,14 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import traceback
-import random
+import hashlib
 import logging
+import functools
 import requests, json
 import time
 import threading
 import base64
 
+from common.cache import TTLCache
 from common.function_calling import extract_text
 from common.rag import RAG
 from models import model, user
@@ -45,12 +46,25 @@ class User:
         """
         self.db = db
         self.config_service = config_service
+        self._model_ref_cache = {}
+        self._user_ref_cache = {}
+        # Avatar URL and content hash per user, written through by fc_generate_avatar
+        self._avatar_cache = TTLCache(
+            max_size=int(config_service.get_property("general", "model_cache_size")),
+            ttl=int(config_service.get_property("general", "model_cache_ttl")),
+        )
+        self._model_cache = TTLCache(
+            max_size=int(config_service.get_property("general", "model_cache_size")),
+            ttl=int(config_service.get_property("general", "model_cache_ttl")),
+        )
         self.gemini_client = gemini_client
         self.socketio = socketio
 
 
     @staticmethod
+    @functools.cache
     def get_function_declarations():
+        # Built once; every caller shares the same Tool instance
         fc_show_my_model = types.FunctionDeclaration(
             name='fc_show_my_model',
             description='Show user\'s model / character on the screen.',
@@ -75,17 +89,51 @@ class User:
             fc_show_my_avatar,
         ])
     
+    def _query_model_doc(self, user_id):
+        """Queries the user's model document and caches its reference."""
+        query = self.db.collection("models").where(filter=FieldFilter("user_id", "==", user_id)).select(model.Model.FIELDS).limit(1)
+        results = query.get()
+
+        if not results:
+            return None
+
+        self._model_ref_cache[user_id] = results[0].reference
+        return results[0]
+
+    def _get_user_ref(self, user_id):
+        """Resolves and caches the Firestore reference of the user's document."""
+        user_ref = self._user_ref_cache.get(user_id)
+        if user_ref is not None:
+            return user_ref
+
+        query = self.db.collection("users").where(filter=FieldFilter("user_id", "==", user_id)).limit(1)
+        user_ref = self._user_ref_cache[user_id] = query.get()[0].reference
+        return user_ref
+
     def fc_show_my_model(self, user_id):
-        logging.info(f"Showing user's ({user_id}) character")
+        logging.info("Showing user's (%s) character", user_id)
         return '''Reply something like "there you go"''', '''<script>$("#modelWindow").show();</script>'''
 
     def fc_show_my_avatar(self, user_id):
-        logging.info(f"Showing user's ({user_id}) avatar")
+        logging.info("Showing user's (%s) avatar", user_id)
+
+        avatar_src = "/static/avatars/%s.png" % user_id
+        try:
+            # The content hash only changes with the image, so browsers can cache it
+            user_doc = self._avatar_cache.get(user_id)
+            if user_doc is None:
+                user_doc = self._get_user_ref(user_id).get(field_paths=["avatar", "avatar_hash"]).to_dict() or {}
+                self._avatar_cache.put(user_id, user_doc)
+            if user_doc.get("avatar_hash"):
+                avatar_src = "%s?v=%s" % (user_doc.get("avatar") or avatar_src, user_doc["avatar_hash"])
+        except Exception as e:
+            logging.warning("Failed to look up avatar for '%s': %s", user_id, e)
+
         return '''Reply something like "There you go."''', '''
             <div>
                 <br>
-                <img class="avatar" src="/static/avatars/%s.png?rand=%s">
-            </div>''' % (user_id, str(random.randint(0, 1000000)))
+                <img class="avatar" src="%s">
+            </div>''' % avatar_src
 
     def get_model(self, user_id):
         """
@@ -97,28 +145,24 @@ class User:
         Returns:
             A dictionary containing the character's color information, or None if not found.
         """
-        try:
-            # Get the models collection reference
-            models_ref = self.db.collection("models")
+        cached_model = self._model_cache.get(user_id)
+        if cached_model is not None:
+            return cached_model
 
-            # Query for the model with the given user_id
-            query = models_ref.where("user_id", "==", user_id)
-            results = query.get()
+        try:
+            model_ref = self._model_ref_cache.get(user_id)
+            model_doc = model_ref.get(field_paths=model.Model.FIELDS) if model_ref is not None else self._query_model_doc(user_id)
 
-            if not results:
-                logging.warning(f"No character found for '{user_id}'.")
+            if model_doc is None or not model_doc.exists:
+                self._model_ref_cache.pop(user_id, None)
+                logging.warning("No character found for '%s'.", user_id)
                 return None
 
-            # In our current setup, there should only be one matching model
-            # model_doc = results[0]
-            # model_data = model_doc.to_dict()
-            
-            return model.Model.from_dict(results[0].to_dict())
-
-            # we return the full object since it is now already a dict
-            # return model_data
+            user_model = model.Model.from_dict(model_doc.to_dict())
+            self._model_cache.put(user_id, user_model)
+            return user_model
 
         except Exception as e:
-            logging.error("%s, %s", traceback.format_exc(), e)
+            logging.exception("Failed to get model for '%s': %s", user_id, e)
             return None
         
\ No newline at end of file